@@ -1,15 +1,48 @@
 # backend/app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS # For Cross-Origin Resource Sharing
+from flask_compress import Compress # gzip/brotli response compression
+import orjson # Fast JSON serialization for API responses
 import os
+import hashlib # For content-addressed caching of analysis results
 import tempfile # For temporary file storage
+import multiprocessing
+import threading
+import functools
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor # PM4PY discovery / LLM review off the request thread
+from concurrent.futures.process import BrokenProcessPool
+from diskcache import Cache # Persistent cache shared across workers/restarts
 from werkzeug.utils import secure_filename # For secure filenames
+from streaming_form_data import StreamingFormDataParser # Streams multipart bodies without spooling
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget
 
 # Import your custom modules
 from pm_engine import analyze_event_log
-from llm_review import get_llm_insights
+from llm_review import get_llm_insights, warm_up_model
+
+# Options for every orjson.dumps call on the response path: numpy/pandas values are serialized as-is
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+class OrjsonProvider(JSONProvider):
+    """
+    Flask JSON provider backed by orjson, so jsonify() and app.json use it.
+    Responses are built from orjson's bytes directly, skipping the str -> bytes encode.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=ORJSON_OPTIONS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=ORJSON_OPTIONS), mimetype="application/json")
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # PRD Section 8: CORS configuration
 # Allow requests from your Vercel frontend (and localhost for dev)
@@ -19,86 +52,266 @@ CORS(app)
 # CORS(app, resources={r"/api/*": {"origins": ["http://localhost:3000", "https://your-vercel-app-domain.vercel.app"]}})
 
 
+# Response compression: DFG JSON repeats activity names on every link, so it compresses very well.
+app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_LEVEL"] = 4 # gzip
+app.config["COMPRESS_BR_LEVEL"] = 4
+Compress(app)
+
 # Define allowed file extensions (as per PRD)
 ALLOWED_EXTENSIONS = {'.csv', '.xes'}
 
+# Bytes read from the request body per iteration when streaming an upload to disk.
+# 1 MiB chunks amortize the per-chunk Python overhead (read, parse, write) on large XES/CSV files,
+# and are big enough that the file write bypasses the BufferedWriter's internal copy.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# On-disk cache of analyze_event_log results, keyed by the uploaded file's content hash:
+# re-uploading the same log skips parsing and discovery entirely (the output is deterministic).
+GRAPH_CACHE_DIR = os.getenv("GRAPH_CACHE_DIR", "/var/cache/pmweb/graph")
+GRAPH_CACHE_TTL_SEC = int(os.getenv("GRAPH_CACHE_TTL_SEC", "86400")) # 1 day
+GRAPH_CACHE = Cache(GRAPH_CACHE_DIR) # Values are pickled with pickle.HIGHEST_PROTOCOL
+
+# Bounded pool for the I/O-bound Ollama calls; requests releases the GIL while waiting on the socket
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_EXECUTOR_WORKERS", "4")), thread_name_prefix="llm-review")
+
+# Process pool for analyze_event_log: keeps the GIL-heavy parsing/discovery off the Flask threads and
+# isolates crashes in the C extensions from the web process. forkserver children start from a clean
+# server process that has pm_engine (pandas) preloaded and no open sockets. Under Gunicorn that is all
+# they load; under the dev server (python app.py) multiprocessing also re-imports app.py as __mp_main__
+# in every child, so each pool worker additionally loads Flask, diskcache and llm_review's imports.
+PM_POOL_WORKERS = int(os.getenv("PM_POOL_WORKERS", max(2, (os.cpu_count() or 2) - 1)))
+PM_ANALYSIS_TIMEOUT_SEC = int(os.getenv("PM_ANALYSIS_TIMEOUT_SEC", "120"))
+_pm_pool = None
+_pm_pool_pid = None
+_pm_pool_lock = threading.Lock()
+
+def get_pm_pool():
+    """
+    Returns this process's analysis pool, creating it on first use. Created lazily (not at import) so that
+    each Gunicorn worker forked from a preloaded master gets its own pool and queues.
+    """
+    global _pm_pool, _pm_pool_pid
+    with _pm_pool_lock:
+        if _pm_pool is None or _pm_pool_pid != os.getpid():
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload(["pm_engine"])
+            _pm_pool = ProcessPoolExecutor(max_workers=PM_POOL_WORKERS, mp_context=mp_context)
+            _pm_pool_pid = os.getpid()
+        return _pm_pool
+
+def reset_pm_pool(stale_pool):
+    """
+    Drops stale_pool (one of its workers died), so the next request starts a fresh one. Only resets if
+    stale_pool is still the current pool: concurrent requests that failed on the same pool must not
+    shut down the replacement another request already created.
+    """
+    global _pm_pool
+    with _pm_pool_lock:
+        if _pm_pool is not stale_pool:
+            return
+        _pm_pool = None
+    stale_pool.shutdown(wait=False, cancel_futures=True)
+
+# Analyses still running in this process's pool, by graph cache key. A job that outlives its request's
+# timeout is not wasted: its done-callback stores the graph in GRAPH_CACHE, and a retry that arrives
+# before then waits on the same future instead of analyzing the file again.
+_pending_analyses = {}
+_pending_analyses_lock = threading.Lock()
+
+def remove_temp_file(temp_file_path):
+    if os.path.exists(temp_file_path):
+        try:
+            os.remove(temp_file_path)
+            print(f"Cleaned up temp file: {temp_file_path}")
+        except Exception as e_clean:
+            print(f"Error cleaning up temp file {temp_file_path}: {e_clean}")
+
+def submit_analysis(graph_cache_key, temp_file_path, original_filename):
+    """
+    Returns (pool, future, submitted) for the analysis of this content, reusing a job that is already
+    running for the same key. Once submitted, the job owns temp_file_path and removes it when done.
+    """
+    with _pending_analyses_lock:
+        pending = _pending_analyses.get(graph_cache_key)
+        if pending is not None:
+            return pending + (False,)
+        pool = get_pm_pool()
+        future = pool.submit(analyze_event_log, temp_file_path, original_filename)
+        _pending_analyses[graph_cache_key] = (pool, future)
+    future.add_done_callback(functools.partial(_on_analysis_done, graph_cache_key, temp_file_path))
+    return pool, future, True
+
+def _on_analysis_done(graph_cache_key, temp_file_path, future):
+    # Cache before dropping the pending entry, so a concurrent retry finds one or the other
+    if not future.cancelled() and future.exception() is None and future.result():
+        GRAPH_CACHE.set(graph_cache_key, future.result(), expire=GRAPH_CACHE_TTL_SEC)
+    with _pending_analyses_lock:
+        _pending_analyses.pop(graph_cache_key, None)
+    remove_temp_file(temp_file_path)
+
+class HashingFileTarget(FileTarget):
+    """FileTarget that also hashes the bytes as they are written, so no second pass over the file is needed."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.content_hash = hashlib.blake2b(digest_size=16)
+        self.bytes_hashed = 0
+        self.upload_finished = False
+
+    def on_start(self):
+        # FileTarget reopens (truncates) the file for every part with this name, so the hash must
+        # restart too; otherwise the key would cover all parts while the file holds only the last one.
+        self.content_hash = hashlib.blake2b(digest_size=16)
+        self.bytes_hashed = 0
+        self.upload_finished = False
+        super().on_start()
+
+    def on_data_received(self, chunk):
+        self.content_hash.update(chunk)
+        self.bytes_hashed += len(chunk)
+        super().on_data_received(chunk)
+
+    def on_finish(self):
+        # Only called once the part's closing boundary was parsed; a body cut short never gets here
+        super().on_finish()
+        self.upload_finished = True
+
+    def close(self):
+        """Closes the file if the part never finished, so early returns do not leak the descriptor."""
+        if self._fd and not self._fd.closed:
+            self._fd.close()
+
 def allowed_file(filename):
     return '.' in filename and \
            os.path.splitext(filename)[1].lower() in ALLOWED_EXTENSIONS
 
+def get_llm_insights_or_default(process_graph_data, process_summary_text):
+    """
+    Wraps get_llm_insights so the insights part of the response is always filled (runs on LLM_EXECUTOR,
+    where an exception would otherwise only surface when the future is read).
+    """
+    try:
+        llm_insights = get_llm_insights(process_graph_data, process_summary_text)
+    except Exception as e:
+        print(f"Error while getting LLM insights: {e}")
+        llm_insights = None
+    if not llm_insights: # If LLM fails but graph is ok, still return graph
+        print("Warning: Failed to get LLM insights, but process graph was generated.")
+        # Provide a default error structure for LLM insights part of the response
+        llm_insights = {
+            "summary": "LLM analysis unavailable at this time.",
+            "bottlenecks": [], "rework_loops": [], "inefficiencies": [], "anomalies": []
+        }
+    return llm_insights
+
 @app.route('/api/process', methods=['POST']) # PRD Section 5.3 & 5.4
 def process_log_file():
     # PRD Section 5.3: Expects multipart/form-data with a file
-    if 'file' not in request.files:
+    # The body is parsed as it arrives and the 'file' part is written straight to disk,
+    # instead of letting Werkzeug spool it (request.files) and then copying it again with file.save().
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+    except ParseFailedException:
         return jsonify({"success": False, "message": "No file part in the request.", "data": None}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"success": False, "message": "No selected file.", "data": None}), 400
-
-    if file and allowed_file(file.filename):
-        original_filename = secure_filename(file.filename) # Sanitize filename
-        
-        # PRD Section 5.3: Backend stores temporarily (or in memory) for analysis.
-        # Using a temporary file is safer and handles larger files better than in-memory for PM4PY.
-        temp_dir = tempfile.gettempdir()
-        temp_file_path = os.path.join(temp_dir, original_filename)
-        
+
+    # PRD Section 5.3: Backend stores temporarily (or in memory) for analysis.
+    # Using a temporary file is safer and handles larger files better than in-memory for PM4PY.
+    # The original filename is only known once the part headers are parsed, so write to a unique
+    # temp path; analyze_event_log gets the file type from original_filename anyway.
+    temp_fd, temp_file_path = tempfile.mkstemp(prefix='pmweb_upload_')
+    os.close(temp_fd)
+    pm_pool = None
+    analysis_submitted = False # Once True, the analysis job removes the temp file
+    target = HashingFileTarget(temp_file_path)
+
+    try:
+        parser.register('file', target)
+
         try:
-            file.save(temp_file_path)
-            
-            # 1. Process with PM4PY engine (pm_engine.py)
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.data_received(chunk)
+        except ParseFailedException as pfe:
+            return jsonify({"success": False, "message": f"Malformed multipart upload: {pfe}", "data": None}), 400
+
+        if target.multipart_filename is None:
+            return jsonify({"success": False, "message": "No file part in the request.", "data": None}), 400
+        if not target.upload_finished: # Unflushed and truncated on disk, and the hash would not match the file
+            return jsonify({"success": False, "message": "Malformed multipart upload: the file part is incomplete.", "data": None}), 400
+        if target.multipart_filename == '':
+            return jsonify({"success": False, "message": "No selected file.", "data": None}), 400
+        if not allowed_file(target.multipart_filename):
+            return jsonify({"success": False, "message": f"File type not allowed. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}", "data": None}), 400
+
+        # The graph cache is keyed by the hash, so it must describe exactly the bytes that will be analyzed
+        if os.path.getsize(temp_file_path) != target.bytes_hashed:
+            return jsonify({"success": False, "message": "Malformed multipart upload: file part size mismatch.", "data": None}), 400
+
+        original_filename = secure_filename(target.multipart_filename) # Sanitize filename
+
+        # 1. Process with PM4PY engine (pm_engine.py), unless this exact file was analyzed before.
+        # The extension is part of the key because it decides how the bytes are parsed.
+        file_type = os.path.splitext(original_filename)[1].lower()
+        graph_cache_key = f"{file_type}:{target.content_hash.hexdigest()}"
+        process_graph_data = GRAPH_CACHE.get(graph_cache_key)
+        if process_graph_data is not None:
+            print(f"Returning cached process graph for {original_filename} (key {graph_cache_key})")
+        else:
             print(f"Processing file: {temp_file_path} (Original: {original_filename})")
-            process_graph_data = analyze_event_log(temp_file_path, original_filename)
-            if not process_graph_data: # Should not happen if analyze_event_log raises on error
-                return jsonify({"success": False, "message": "Failed to analyze event log with PM4PY.", "data": None}), 500
-
-            # (Optional for PRD 6.B) Create a textual summary for the LLM
-            # For PoC, this can be simple or omitted if LLM is good with just graph data
-            num_nodes = len(process_graph_data.get("nodes", []))
-            num_links = len(process_graph_data.get("links", []))
-            process_summary_text = f"The discovered process model has {num_nodes} activities (nodes) and {num_links} transitions (links)."
-
-            # 2. Get LLM insights (llm_review.py)
-            llm_insights = get_llm_insights(process_graph_data, process_summary_text)
-            if not llm_insights: # If LLM fails but graph is ok, still return graph
-                 print("Warning: Failed to get LLM insights, but process graph was generated.")
-                 # Provide a default error structure for LLM insights part of the response
-                 llm_insights = {
-                     "summary": "LLM analysis unavailable at this time.",
-                     "bottlenecks": [], "rework_loops": [], "inefficiencies": [], "anomalies": []
-                 }
-            
-            # PRD Section 5.4: Response structure
-            response_data = {
-                "success": True,
-                "message": "Processing successful.",
-                "data": {
-                    "processGraph": process_graph_data,
-                    "llmInsights": llm_insights
-                }
-            }
-            return jsonify(response_data), 200
-
-        except ValueError as ve: # Catch specific errors from pm_engine or other validation
-            print(f"Validation Error: {ve}")
-            return jsonify({"success": False, "message": str(ve), "data": None}), 400
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            # Log the full traceback here in a real application
-            # import traceback
-            # traceback.print_exc()
-            return jsonify({"success": False, "message": f"An internal server error occurred: {str(e)}", "data": None}), 500
-        finally:
-            # Clean up the temporary file
-            if os.path.exists(temp_file_path):
-                try:
-                    os.remove(temp_file_path)
-                    print(f"Cleaned up temp file: {temp_file_path}")
-                except Exception as e_clean:
-                    print(f"Error cleaning up temp file {temp_file_path}: {e_clean}")
-    else:
-        return jsonify({"success": False, "message": f"File type not allowed. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}", "data": None}), 400
+            pm_pool, analysis_future, analysis_submitted = submit_analysis(graph_cache_key, temp_file_path, original_filename)
+            process_graph_data = analysis_future.result(timeout=PM_ANALYSIS_TIMEOUT_SEC)
+        if not process_graph_data: # Should not happen if analyze_event_log raises on error
+            return jsonify({"success": False, "message": "Failed to analyze event log with PM4PY.", "data": None}), 500
+
+        # (Optional for PRD 6.B) Create a textual summary for the LLM
+        # For PoC, this can be simple or omitted if LLM is good with just graph data
+        num_nodes = len(process_graph_data.get("nodes", []))
+        num_links = len(process_graph_data.get("links", []))
+        process_summary_text = f"The discovered process model has {num_nodes} activities (nodes) and {num_links} transitions (links)."
+
+        # 2. Get LLM insights (llm_review.py) in the background: Ollama only needs the finished graph,
+        # so the response serialization below overlaps with LLM decoding (the graph was cached by _on_analysis_done).
+        llm_insights_future = LLM_EXECUTOR.submit(get_llm_insights_or_default, process_graph_data, process_summary_text)
+
+        # PRD Section 5.4: Response structure. The whole body is compressed as one piece (a streamed body
+        # would only be released by the compressor at the end anyway), so serialize the processGraph part
+        # now, while Ollama is still decoding, and append llmInsights once it is done.
+        response_head = (
+            b'{"success":true,"message":"Processing successful.","data":{"processGraph":'
+            + orjson.dumps(process_graph_data, option=ORJSON_OPTIONS)
+            + b',"llmInsights":'
+        )
+        llm_insights = llm_insights_future.result() # Never raises: falls back to the default structure
+        response_body = response_head + orjson.dumps(llm_insights, option=ORJSON_OPTIONS) + b'}}'
+        return Response(response_body, status=200, mimetype='application/json')
+
+    except concurrent.futures.TimeoutError: # Not the builtin TimeoutError before Python 3.11
+        print(f"Event log analysis timed out after {PM_ANALYSIS_TIMEOUT_SEC}s: {temp_file_path}")
+        # A running job cannot be cancelled, so it is left to finish in its pool slot: its done-callback
+        # caches the graph, so a retry of a slow-but-valid log is served from GRAPH_CACHE (or waits on the
+        # same job) instead of starting over.
+        return jsonify({"success": False, "message": f"Event log analysis timed out after {PM_ANALYSIS_TIMEOUT_SEC} seconds.", "data": None}), 504
+    except BrokenProcessPool as bpe:
+        print(f"Event log analysis worker crashed: {bpe}")
+        reset_pm_pool(pm_pool)
+        return jsonify({"success": False, "message": "Event log analysis failed unexpectedly. Please try again.", "data": None}), 500
+    except ValueError as ve: # Catch specific errors from pm_engine or other validation
+        print(f"Validation Error: {ve}")
+        return jsonify({"success": False, "message": str(ve), "data": None}), 400
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        # Log the full traceback here in a real application
+        # import traceback
+        # traceback.print_exc()
+        return jsonify({"success": False, "message": f"An internal server error occurred: {str(e)}", "data": None}), 500
+    finally:
+        # Clean up the temporary file
+        target.close()
+        if not analysis_submitted:
+            remove_temp_file(temp_file_path)
 
 # Simple health check endpoint
 @app.route('/api/health', methods=['GET'])
@@ -106,9 +319,8 @@ def health_check():
     return jsonify({"status": "healthy", "message": "Backend is running!"}), 200
 
 if __name__ == '__main__':
-    # For development, Flask's built-in server is fine.
-    # For production, use a WSGI server like Gunicorn or uWSGI.
-    # Debug mode should be False in production.
+    # Development only: Flask's built-in server handles one request at a time.
+    # For production, run under Gunicorn instead: gunicorn -c gunicorn_conf.py app:app
     # host='0.0.0.0' makes it accessible on your network, useful for ngrok.
-    app.run(host='0.0.0.0', port=5000, debug=True)
-
+    warm_up_model() # Load the LLM in Ollama now rather than on the first upload
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv("FLASK_DEBUG", "0") == "1")
@@ -0,0 +1,31 @@
+# backend/gunicorn_conf.py
+# Production WSGI server settings. Run from the backend/ directory:
+#   gunicorn -c gunicorn_conf.py app:app
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+
+# Several processes for the CPU-bound pandas event-log work, each with a few threads
+# so uploads waiting on Ollama don't hold up the others
+workers = int(os.getenv("GUNICORN_WORKERS", max(2, (os.cpu_count() or 2) // 2)))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_class = "gthread"
+# Note: each worker also runs its own event-log analysis process pool (PM_POOL_WORKERS processes, see app.py);
+# lower PM_POOL_WORKERS when running many workers to avoid oversubscribing the CPUs
+
+# LLM review plus discovery on a large log can take well over the 30s default
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "180"))
+
+# Recycle workers periodically to bound memory growth from large DataFrames
+max_requests = 100
+max_requests_jitter = 20
+
+# Import the app (pandas, numpy, pyarrow) once in the master; workers share those pages copy-on-write.
+# The diskcache caches reopen their SQLite connection per process after the fork.
+preload_app = True
+
+def when_ready(server):
+    # Load the LLM in Ollama once, from the master, rather than on the first upload.
+    # Done here instead of at import so no HTTP connection exists in the master before workers fork.
+    from llm_review import warm_up_model
+    warm_up_model()
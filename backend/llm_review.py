@@ -1,18 +1,257 @@
 # backend/llm_review.py
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import orjson # Fast cache-key serialization and parsing of the streamed Ollama output
+import xxhash # For caching key
 import os
 from dotenv import load_dotenv
-import hashlib # For caching key
+import math
+from string import Template
+import threading
+from diskcache import Cache # Persistent cache shared across workers/restarts
+import numpy as np
 
 load_dotenv() # Load environment variables from .env
 
 OLLAMA_API_BASE_URL = os.getenv("OLLAMA_API_BASE_URL", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3:8b-instruct") # As per PRD Section 1 & 6.B
+# Keep the model weights loaded between requests instead of Ollama's default idle unload
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# num_ctx is fixed (changing it makes Ollama reload the model) at llama3's 8k window; get_llm_insights
+# shrinks the graph until the prompt plus num_predict fits, because Ollama silently drops the start of
+# an over-long prompt. temperature 0 keeps the output deterministic, which also makes cached insights reusable
+OLLAMA_OPTIONS = {
+    "num_ctx": int(os.getenv("OLLAMA_NUM_CTX", "8192")),
+    "num_predict": int(os.getenv("OLLAMA_NUM_PREDICT", "512")),
+    "temperature": 0.0,
+    "num_thread": os.cpu_count(),
+}
 
-# Simple in-memory cache for PoC (PRD Section 6.B - Caching)
-# For production, consider Redis, memcached, or diskcache (e.g., joblib.Memory)
-LLM_CACHE = {}
+# On-disk cache for LLM insights (PRD Section 6.B - Caching)
+# Backed by diskcache (SQLite + files), so hits survive restarts and are shared by every worker process.
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "/var/cache/pmweb/llm")
+LLM_CACHE_TTL_SEC = int(os.getenv("LLM_CACHE_TTL_SEC", "86400")) # 1 day
+LLM_CACHE = Cache(LLM_CACHE_DIR)
+
+# Semantic cache: near-duplicate graphs (e.g. one edge count shifted by a few) reuse earlier insights.
+# Fingerprint embeddings are stored in SEMANTIC_CACHE (keyed like LLM_CACHE, same TTL) so they survive
+# restarts and are shared by workers; each worker rebuilds its faiss index from it whenever the store
+# has changed. The insights themselves stay in LLM_CACHE, so an expired entry simply falls through to Ollama.
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97")) # Cosine similarity
+# Only the highest-count edges go into the fingerprint, so it stays within the model's input limit
+SEMANTIC_FINGERPRINT_EDGES = int(os.getenv("SEMANTIC_FINGERPRINT_EDGES", "16"))
+SEMANTIC_CACHE = Cache(os.path.join(LLM_CACHE_DIR, "semantic"))
+_embedding_model = None
+_embedding_model_failed = False # Set once loading fails (missing package, HF hub offline), so it is not retried per request
+_embedding_model_lock = threading.Lock()
+_semantic_index = None # faiss.IndexFlatIP over normalized embeddings (inner product == cosine)
+_semantic_cache_keys = [] # Row i of _semantic_index -> LLM_CACHE key
+_semantic_indexed_count = 0 # len(SEMANTIC_CACHE) when the index was last built
+_semantic_lock = threading.Lock()
+
+def _graph_fingerprint(process_graph_data):
+    """
+    Canonical text form of the graph: its size plus the top SEMANTIC_FINGERPRINT_EDGES edges by count,
+    sorted, with log2-bucketed counts.
+    """
+    links = process_graph_data.get('links', [])
+    top_links = sorted(links, key=lambda link: link.get('count') or 0, reverse=True)[:SEMANTIC_FINGERPRINT_EDGES]
+    edges = sorted(
+        (str(link.get('source')), str(link.get('target')), int(math.log2((link.get('count') or 0) + 1)))
+        for link in top_links
+    )
+    header = f"{len(process_graph_data.get('nodes', []))} nodes, {len(links)} edges: "
+    return header + "; ".join(f"{source} -> {target} [{bucket}]" for source, target, bucket in edges)
+
+def _get_embedding_model():
+    """
+    Loads the embedding model once per process; returns None if loading failed (the failure is remembered).
+    faiss and sentence-transformers (torch) are imported here rather than at module level, so the Gunicorn
+    master and workers that never embed do not load them, and a missing package only disables the cache.
+    """
+    global _embedding_model, _embedding_model_failed
+    with _embedding_model_lock:
+        if _embedding_model is None and not _embedding_model_failed:
+            try:
+                import faiss # noqa: F401 -- used by _refresh_semantic_index, checked here with the model
+                from sentence_transformers import SentenceTransformer # Local embedding model for graph fingerprints
+                _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+            except Exception as e:
+                _embedding_model_failed = True
+                print(f"LLM Review: Could not load embedding model {EMBEDDING_MODEL_NAME}, semantic cache disabled: {e}")
+        return _embedding_model
+
+def _embed_fingerprint(fingerprint):
+    """
+    Returns a (1, dim) float32 normalized embedding, or None when the model is unavailable or the
+    fingerprint would be truncated by the model (truncated inputs make unrelated graphs look identical).
+    """
+    model = _get_embedding_model()
+    if model is None:
+        return None
+    num_tokens = len(model.tokenizer(fingerprint)["input_ids"])
+    if num_tokens > model.max_seq_length:
+        print(f"LLM Review: Fingerprint too long for the semantic cache ({num_tokens} > {model.max_seq_length} tokens), skipping it")
+        return None
+    return model.encode([fingerprint], normalize_embeddings=True, convert_to_numpy=True).astype('float32')
+
+def _refresh_semantic_index():
+    """Rebuilds this worker's faiss index from SEMANTIC_CACHE if entries were added or expired. Caller holds _semantic_lock."""
+    global _semantic_index, _semantic_cache_keys, _semantic_indexed_count
+    import faiss # Vector index for the semantic cache; already imported by _get_embedding_model
+    stored_count = len(SEMANTIC_CACHE)
+    if _semantic_index is not None and stored_count == _semantic_indexed_count:
+        return
+    keys, embeddings = [], []
+    for cache_key in SEMANTIC_CACHE:
+        embedding_bytes = SEMANTIC_CACHE.get(cache_key)
+        if embedding_bytes is not None: # May have expired since iteration started
+            keys.append(cache_key)
+            embeddings.append(np.frombuffer(embedding_bytes, dtype='float32'))
+    _semantic_index = None
+    if embeddings:
+        matrix = np.vstack(embeddings)
+        _semantic_index = faiss.IndexFlatIP(matrix.shape[1])
+        _semantic_index.add(matrix)
+    _semantic_cache_keys = keys
+    _semantic_indexed_count = stored_count
+
+def _semantic_cache_lookup(embedding):
+    with _semantic_lock:
+        _refresh_semantic_index()
+        if _semantic_index is None or _semantic_index.ntotal == 0:
+            return None
+        scores, ids = _semantic_index.search(embedding, 1)
+        score, row = float(scores[0][0]), int(ids[0][0])
+        if row < 0 or score < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        cache_key = _semantic_cache_keys[row]
+    insights = LLM_CACHE.get(cache_key)
+    if insights is not None:
+        print(f"LLM Review: Semantic cache hit (similarity {score:.3f}) for key {cache_key}")
+    return insights
+
+def _semantic_cache_add(embedding, cache_key):
+    # Persisted only; every worker (this one included) picks it up on its next index refresh
+    SEMANTIC_CACHE.set(cache_key, embedding.tobytes(), expire=LLM_CACHE_TTL_SEC)
+
+# PRD Section 6.B: Prompt Template, parsed once at import ($-placeholders leave the JSON braces literal)
+PROMPT_TEMPLATE = Template("""
+You are an expert process mining analyst. Analyze the following discovered process model:
+
+**Process Model Data:**
+Nodes (Activities):
+$nodes_json
+
+Edges (Transitions):
+$links_json
+
+**Process Summary (if provided):**
+$summary_text
+
+**Your Task:**
+Based *only* on the provided data, identify and describe:
+1.  **Summary:** A brief (1-2 sentences) overall assessment of the process.
+2.  **Potential Bottlenecks:** Activities that might be bottlenecks due to high frequency, long duration (if available in data), or being a convergence point with many incoming high-frequency paths. List up to 3.
+3.  **Significant Rework Loops/Repeated Sequences:** Identify sequences of activities that indicate rework (e.g., A -> B -> A, or A -> B -> C -> A based on the provided links). List up to 2.
+4.  **Key Inefficiencies/Observations:** Other notable patterns, like very low-frequency paths that might be exceptions, or high-frequency paths that represent the "happy path". List up to 3.
+5.  **Anomalies:** Any unusual patterns or transitions that stand out. List up to 2.
+
+**Output Format:**
+Return your analysis *only* as a single, minified JSON object matching this structure:
+{
+  "summary": "string",
+  "bottlenecks": [{ "activity": "string", "reason": "string" }],
+  "rework_loops": [{ "loop": ["string", ...], "impact": "string" }],
+  "inefficiencies": [{ "observation": "string", "suggestion": "string (optional)" }],
+  "anomalies": [{ "item": "string (e.g., activity name or path A->B)", "description": "string" }]
+}
+Ensure the output is valid JSON. Do not include any explanations or text outside this JSON structure.
+""")
+
+# One pooled HTTP session for all Ollama calls, so the connection to Ollama is kept alive between requests.
+# Created per process (like app.get_pm_pool) so Gunicorn workers forked from a preloaded master never
+# share a pooled keep-alive socket, which would cross their responses.
+_ollama_session = None
+_ollama_session_pid = None
+_ollama_session_lock = threading.Lock()
+
+def _get_ollama_session():
+    global _ollama_session, _ollama_session_pid
+    with _ollama_session_lock:
+        if _ollama_session is None or _ollama_session_pid != os.getpid():
+            _ollama_session = requests.Session()
+            _ollama_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+            _ollama_session_pid = os.getpid()
+        return _ollama_session
+
+# Prompt size limits: larger graphs are truncated to their most frequent nodes/edges
+MAX_PROMPT_NODES = int(os.getenv("MAX_PROMPT_NODES", "50"))
+MAX_PROMPT_LINKS = int(os.getenv("MAX_PROMPT_LINKS", "100"))
+# Conservative estimate for minified JSON (short keys, digits and punctuation tokenize densely)
+PROMPT_CHARS_PER_TOKEN = 3
+
+def _estimate_prompt_tokens(prompt):
+    return math.ceil(len(prompt) / PROMPT_CHARS_PER_TOKEN)
+
+def _round_seconds(key, value):
+    """Whole seconds are plenty for the LLM; full-precision floats cost several tokens each."""
+    return round(value) if key.endswith('_sec') and isinstance(value, float) else value
+
+def _compact_graph_for_prompt(process_graph_data, max_nodes=MAX_PROMPT_NODES, max_links=MAX_PROMPT_LINKS):
+    """
+    Shrinks the graph before it is embedded in the prompt.
+
+    Drops 'label' (it duplicates 'id') and empty (None) fields, rounds '*_sec' values to whole seconds, and
+    keeps the top max_nodes nodes by frequency and the top max_links links by count among them. Graphs
+    within the limits pass through unchanged apart from the dropped/rounded fields.
+
+    Returns:
+        (nodes, links, omitted_note) where omitted_note is "" or a line describing what was left out.
+    """
+    nodes = process_graph_data.get('nodes', [])
+    links = process_graph_data.get('links', [])
+
+    if len(nodes) > max_nodes:
+        nodes = sorted(nodes, key=lambda node: node.get('frequency') or 0, reverse=True)[:max_nodes]
+        kept_ids = {node.get('id') for node in nodes}
+        links = [link for link in links if link.get('source') in kept_ids and link.get('target') in kept_ids]
+    if len(links) > max_links:
+        links = sorted(links, key=lambda link: link.get('count') or 0, reverse=True)[:max_links]
+
+    omitted_nodes = len(process_graph_data.get('nodes', [])) - len(nodes)
+    omitted_links = len(process_graph_data.get('links', [])) - len(links)
+    omitted_note = ""
+    if omitted_nodes or omitted_links:
+        omitted_note = f"\n...and {omitted_nodes} more low-frequency activities and {omitted_links} more low-frequency edges omitted"
+
+    prompt_nodes = [{k: _round_seconds(k, v) for k, v in node.items() if k != 'label' and v is not None} for node in nodes]
+    prompt_links = [{k: _round_seconds(k, v) for k, v in link.items() if v is not None} for link in links]
+    return prompt_nodes, prompt_links, omitted_note
+
+def warm_up_model():
+    """
+    Asks Ollama to load OLLAMA_MODEL (an empty prompt only loads the weights) in a background thread,
+    so the first real request does not pay the model load time. Called once at server start (see
+    gunicorn_conf.when_ready and app.py's __main__); it uses a one-off connection, not the shared session.
+    """
+    def _warm_up():
+        try:
+            response = requests.post(
+                f"{OLLAMA_API_BASE_URL}/api/generate",
+                headers={"Connection": "close"},
+                # Same options as real requests: a different num_ctx would make Ollama reload the model then
+                json={"model": OLLAMA_MODEL, "prompt": "", "keep_alive": OLLAMA_KEEP_ALIVE, "options": OLLAMA_OPTIONS},
+                timeout=120,
+            )
+            response.raise_for_status()
+            print(f"LLM Review: Model {OLLAMA_MODEL} loaded (keep_alive={OLLAMA_KEEP_ALIVE}).")
+        except requests.exceptions.RequestException as e:
+            print(f"LLM Review: Could not pre-load model {OLLAMA_MODEL}: {e}")
+
+    threading.Thread(target=_warm_up, name="ollama-warm-up", daemon=True).start()
 
 def get_llm_insights(process_graph_data, process_summary_text=None):
     """
@@ -40,92 +279,103 @@ def get_llm_insights(process_graph_data, process_summary_text=None):
         "graph": process_graph_data,
         "summary_text": process_summary_text or ""
     }
-    # Sort keys for consistent hashing
-    cache_key_string = json.dumps(cache_key_input, sort_keys=True)
-    cache_key = hashlib.md5(cache_key_string.encode('utf-8')).hexdigest()
+    # Sort keys for consistent hashing; xxh3 is only a cache tag, so collision resistance is not needed
+    cache_key_bytes = orjson.dumps(cache_key_input, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    cache_key = xxhash.xxh3_64(cache_key_bytes).hexdigest()
 
-    if cache_key in LLM_CACHE:
+    cached_insights = LLM_CACHE.get(cache_key)
+    if cached_insights is not None:
         print(f"LLM Review: Returning cached response for key {cache_key}")
-        return LLM_CACHE[cache_key]
+        return cached_insights
 
-    # PRD Section 6.B: Construct Prompt Template
-    # Ensure nodes and links are serializable to JSON for the prompt
+    # Exact miss: try the semantic cache before paying for an Ollama call
+    fingerprint_embedding = None
     try:
-        nodes_json_str = json.dumps(process_graph_data.get('nodes', []), indent=2)
-        links_json_str = json.dumps(process_graph_data.get('links', []), indent=2)
-    except TypeError as te:
-        print(f"LLM Review: Error serializing process_graph_data to JSON: {te}")
-        # Potentially handle non-serializable data or raise
-        return None
-
-
-    prompt_template = f"""
-You are an expert process mining analyst. Analyze the following discovered process model:
-
-**Process Model Data:**
-Nodes (Activities):
-{nodes_json_str}
-
-Edges (Transitions):
-{links_json_str}
-
-**Process Summary (if provided):**
-{process_summary_text if process_summary_text else "No additional summary provided."}
+        fingerprint_embedding = _embed_fingerprint(_graph_fingerprint(process_graph_data))
+        similar_insights = _semantic_cache_lookup(fingerprint_embedding) if fingerprint_embedding is not None else None
+        if similar_insights is not None:
+            LLM_CACHE.set(cache_key, similar_insights, expire=LLM_CACHE_TTL_SEC) # Promote to the exact-match path
+            return similar_insights
+    except Exception as e:
+        print(f"LLM Review: Semantic cache unavailable, continuing without it: {e}")
 
-**Your Task:**
-Based *only* on the provided data, identify and describe:
-1.  **Summary:** A brief (1-2 sentences) overall assessment of the process.
-2.  **Potential Bottlenecks:** Activities that might be bottlenecks due to high frequency, long duration (if available in data), or being a convergence point with many incoming high-frequency paths. List up to 3.
-3.  **Significant Rework Loops/Repeated Sequences:** Identify sequences of activities that indicate rework (e.g., A -> B -> A, or A -> B -> C -> A based on the provided links). List up to 2.
-4.  **Key Inefficiencies/Observations:** Other notable patterns, like very low-frequency paths that might be exceptions, or high-frequency paths that represent the "happy path". List up to 3.
-5.  **Anomalies:** Any unusual patterns or transitions that stand out. List up to 2.
+    # PRD Section 6.B: Construct Prompt Template
+    # Ensure nodes and links are serializable to JSON for the prompt
+    # Minified and capped to the most frequent nodes/edges: prompt tokens drive Ollama latency.
+    # If the prompt would not leave room for the answer in num_ctx, halve the limits and rebuild.
+    prompt_token_budget = OLLAMA_OPTIONS["num_ctx"] - OLLAMA_OPTIONS["num_predict"]
+    max_nodes, max_links = MAX_PROMPT_NODES, MAX_PROMPT_LINKS
+    while True:
+        try:
+            prompt_nodes, prompt_links, omitted_note = _compact_graph_for_prompt(process_graph_data, max_nodes, max_links)
+            nodes_json_str = json.dumps(prompt_nodes, separators=(',', ':'))
+            links_json_str = json.dumps(prompt_links, separators=(',', ':')) + omitted_note
+        except TypeError as te:
+            print(f"LLM Review: Error serializing process_graph_data to JSON: {te}")
+            # Potentially handle non-serializable data or raise
+            return None
 
-**Output Format:**
-Return your analysis *only* as a single, minified JSON object matching this structure:
-{{
-  "summary": "string",
-  "bottlenecks": [{{ "activity": "string", "reason": "string" }}],
-  "rework_loops": [{{ "loop": ["string", ...], "impact": "string" }}],
-  "inefficiencies": [{{ "observation": "string", "suggestion": "string (optional)" }}],
-  "anomalies": [{{ "item": "string (e.g., activity name or path A->B)", "description": "string" }}]
-}}
-Ensure the output is valid JSON. Do not include any explanations or text outside this JSON structure.
-"""
+        prompt_template = PROMPT_TEMPLATE.substitute(
+            nodes_json=nodes_json_str,
+            links_json=links_json_str,
+            summary_text=process_summary_text if process_summary_text else "No additional summary provided.",
+        )
+        prompt_tokens = _estimate_prompt_tokens(prompt_template)
+        if prompt_tokens <= prompt_token_budget:
+            break
+        if max_nodes == 1 and max_links == 1:
+            print(f"LLM Review: Prompt (~{prompt_tokens} tokens) exceeds num_ctx budget {prompt_token_budget} even at minimum size.")
+            return None
+        max_nodes, max_links = max(1, max_nodes // 2), max(1, max_links // 2)
+        print(f"LLM Review: Prompt (~{prompt_tokens} tokens) too long for num_ctx, retrying with {max_nodes} nodes / {max_links} links.")
 
     ollama_endpoint = f"{OLLAMA_API_BASE_URL}/api/generate"
     payload = {
         "model": OLLAMA_MODEL,
         "prompt": prompt_template,
         "format": "json", # Ollama can directly output JSON if the model/prompt supports it
-        "stream": False   # We want the full response
+        "stream": True,   # Tokens arrive as NDJSON lines while the model decodes
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": OLLAMA_OPTIONS
     }
 
     try:
         print(f"LLM Review: Sending request to Ollama model {OLLAMA_MODEL}...")
-        response = requests.post(ollama_endpoint, json=payload, timeout=60) # 60s timeout
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-        # Ollama with format="json" should return a JSON object where 'response' key holds the JSON string
-        response_data = response.json()
-        
-        if "response" in response_data:
-            llm_json_output_str = response_data["response"]
-            try:
-                insights = json.loads(llm_json_output_str)
-                LLM_CACHE[cache_key] = insights # Store in cache
-                print("LLM Review: Successfully parsed insights from Ollama.")
-                return insights
-            except json.JSONDecodeError as jde:
-                print(f"LLM Review: Failed to decode JSON from LLM response: {jde}")
-                print(f"LLM Raw Response String: {llm_json_output_str}")
-                return {"summary": "Error: LLM returned malformed JSON.", "bottlenecks": [], "rework_loops": [], "inefficiencies": [], "anomalies": []}
-        elif "error" in response_data:
-             print(f"LLM Review: Ollama API returned an error: {response_data['error']}")
-             return {"summary": f"Error: Ollama API error - {response_data['error']}", "bottlenecks": [], "rework_loops": [], "inefficiencies": [], "anomalies": []}
-        else:
-            print(f"LLM Review: Unexpected response structure from Ollama: {response_data}")
+        # With stream=True the 60s timeout applies between chunks, not to the whole generation
+        with _get_ollama_session().post(ollama_endpoint, json=payload, stream=True, timeout=60) as response:
+            response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+
+            # Each line is a JSON object whose 'response' key holds the next piece of the model's JSON output;
+            # the last one has "done": true. Accumulate the pieces as bytes and parse once at the end.
+            llm_json_output = bytearray()
+            done = False
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                response_chunk = orjson.loads(line)
+                if "error" in response_chunk:
+                    print(f"LLM Review: Ollama API returned an error: {response_chunk['error']}")
+                    return {"summary": f"Error: Ollama API error - {response_chunk['error']}", "bottlenecks": [], "rework_loops": [], "inefficiencies": [], "anomalies": []}
+                llm_json_output += response_chunk.get("response", "").encode('utf-8')
+                if response_chunk.get("done"):
+                    done = True
+                    break
+
+        if not done or not llm_json_output:
+            print(f"LLM Review: Unexpected response structure from Ollama (done={done}, {len(llm_json_output)} bytes)")
             return {"summary": "Error: Unexpected response from LLM.", "bottlenecks": [], "rework_loops": [], "inefficiencies": [], "anomalies": []}
 
+        try:
+            insights = orjson.loads(llm_json_output)
+            LLM_CACHE.set(cache_key, insights, expire=LLM_CACHE_TTL_SEC) # Store in cache
+            if fingerprint_embedding is not None:
+                _semantic_cache_add(fingerprint_embedding, cache_key)
+            print("LLM Review: Successfully parsed insights from Ollama.")
+            return insights
+        except orjson.JSONDecodeError as jde:
+            print(f"LLM Review: Failed to decode JSON from LLM response: {jde}")
+            print(f"LLM Raw Response String: {llm_json_output.decode('utf-8', errors='replace')}")
+            return {"summary": "Error: LLM returned malformed JSON.", "bottlenecks": [], "rework_loops": [], "inefficiencies": [], "anomalies": []}
 
     except requests.exceptions.RequestException as e:
         print(f"LLM Review: Request to Ollama API failed: {e}")
@@ -1,9 +1,8 @@
 # backend/pm_engine.py
 import pandas as pd
-import pm4py
-from pm4py.objects.log.util import dataframe_utils
-from pm4py.objects.conversion.log import converter as log_converter
 import os # For file extension
+import sys # For sys.intern
+import xml.etree.ElementTree as ET # Streaming XES parsing
 
 # PRD Section 5.1: CSV Column Names
 CASE_ID_COL = 'case_id'
@@ -17,6 +16,116 @@ PM4PY_ACTIVITY_COL = 'concept:name'
 PM4PY_TIMESTAMP_COL = 'time:timestamp'
 PM4PY_RESOURCE_COL = 'org:resource' # Optional
 
+def _read_xes_events(file_path):
+    """
+    Streams an XES file into an event DataFrame with PM4PY standard column names (case, activity, timestamp).
+
+    Uses ElementTree.iterparse and clears each event/trace once read, so the full XML tree and the PM4PY
+    EventLog object graph are never materialized; only the three columns are kept.
+    """
+    case_ids, activities, timestamps = [], [], []
+    root = None
+    depth = 0 # Nesting level of the element currently being parsed
+    trace_depth = None # Nesting level of the open <trace>, None outside traces
+    trace_count = 0
+    trace_start = 0 # Index of the open trace's first event in the lists
+    trace_case_id = None
+
+    for xml_event, elem in ET.iterparse(file_path, events=("start", "end")):
+        tag = elem.tag.rpartition('}')[2] # Drop the XES namespace
+        if xml_event == "start":
+            depth += 1
+            if root is None:
+                root = elem
+            if tag == "trace":
+                trace_depth, trace_start, trace_case_id = depth, len(activities), None
+            continue
+
+        if tag == "event" and trace_depth is not None:
+            activity = timestamp = None
+            for attribute in elem:
+                key = attribute.get("key")
+                if key == "concept:name":
+                    activity = attribute.get("value")
+                elif key == "time:timestamp":
+                    timestamp = attribute.get("value")
+            activities.append(activity)
+            timestamps.append(timestamp)
+            elem.clear()
+        elif tag == "trace":
+            # The trace's concept:name may come before or after its events, so fill the case ids in at the end
+            if trace_case_id is None:
+                trace_case_id = f"__trace_{trace_count}" # Prefixed so it cannot collide with a real trace name
+            case_ids.extend([trace_case_id] * (len(activities) - trace_start))
+            trace_count += 1
+            trace_depth = None
+            root.clear() # Release the finished trace
+        elif trace_depth is not None and depth == trace_depth + 1 and elem.get("key") == "concept:name":
+            trace_case_id = elem.get("value")
+        depth -= 1
+
+    if not activities:
+        raise ValueError("XES file contains no events.")
+
+    return pd.DataFrame({
+        PM4PY_CASE_ID_COL: pd.Categorical(case_ids),
+        PM4PY_ACTIVITY_COL: pd.Categorical(activities),
+        PM4PY_TIMESTAMP_COL: pd.to_datetime(timestamps, utc=True, format="ISO8601"),
+    })
+
+def _intern_name(name):
+    """Interns activity names so every node id and link source/target shares one string object."""
+    return sys.intern(name) if isinstance(name, str) else name # Activity columns may also be numeric
+
+def _seconds_or_none(value):
+    """Converts a pandas/numpy mean in seconds to a JSON-friendly float (None when missing)."""
+    return None if pd.isna(value) else float(value)
+
+def _discover_dfg_from_df(df):
+    """
+    Computes the Directly Follows Graph straight from an event DataFrame with PM4PY standard column names,
+    using vectorized pandas operations instead of building a PM4PY EventLog object first.
+    Transition timing comes from the same per-case sweep.
+
+    Returns:
+        (dfg, start_activities, end_activities, edge_lead_times, activity_durations) as plain dicts:
+        dfg maps (source, target) -> count and edge_lead_times maps (source, target) -> mean seconds
+        between the two events; start/end activities map activity -> number of cases, and
+        activity_durations maps activity -> mean seconds until the next event of the same case
+        (activities that only ever end a case have no entry).
+    """
+    # Order events within each case by time; mergesort is stable, so ties keep their file order
+    df = df.sort_values([PM4PY_CASE_ID_COL, PM4PY_TIMESTAMP_COL], kind="mergesort")
+    # observed=True: with categorical columns, only group by value combinations that actually occur
+    events_by_case = df.groupby(PM4PY_CASE_ID_COL, sort=False, observed=True)
+    activities_by_case = events_by_case[PM4PY_ACTIVITY_COL]
+
+    # Each event's successor within the same case (NaN/NaT for the last event of a case)
+    next_activity = activities_by_case.shift(-1)
+    lead_time_sec = (events_by_case[PM4PY_TIMESTAMP_COL].shift(-1) - df[PM4PY_TIMESTAMP_COL]).dt.total_seconds()
+    has_successor = next_activity.notna()
+    transitions = pd.DataFrame({
+        "source": df[PM4PY_ACTIVITY_COL][has_successor],
+        "target": next_activity[has_successor],
+        "lead_time_sec": lead_time_sec[has_successor],
+    })
+    edge_stats = (
+        transitions.groupby(["source", "target"], sort=False, observed=True)["lead_time_sec"]
+        .agg(["size", "mean"])
+    )
+    # An activity's duration is approximated by the time until the case moves on to its next event
+    duration_stats = transitions.groupby("source", sort=False, observed=True)["lead_time_sec"].mean()
+
+    dfg = {(source, target): int(count) for (source, target), count in edge_stats["size"].items()}
+    edge_lead_times = {edge: _seconds_or_none(mean) for edge, mean in edge_stats["mean"].items()}
+    activity_durations = {activity: _seconds_or_none(mean) for activity, mean in duration_stats.items()}
+    start_counts = activities_by_case.first().value_counts()
+    end_counts = activities_by_case.last().value_counts()
+    # value_counts on a categorical also lists categories with zero count
+    start_activities = start_counts[start_counts > 0].to_dict()
+    end_activities = end_counts[end_counts > 0].to_dict()
+    return dfg, start_activities, end_activities, edge_lead_times, activity_durations
+
 def analyze_event_log(file_path_or_stream, original_filename):
     """
     Analyzes an event log file (CSV or XES) and discovers a Directly Follows Graph (DFG).
@@ -46,7 +155,8 @@ def analyze_event_log(file_path_or_stream, original_filename):
             # PRD Section 6.A: Parse CSV
             # Assuming file_path_or_stream is a path for CSV for simplicity in PoC
             # If it's a stream, pandas can read it directly: pd.read_csv(file_path_or_stream)
-            df = pd.read_csv(file_path_or_stream)
+            # The PyArrow engine parses multithreaded into Arrow-backed columns and handles ISO-8601 timestamps natively
+            df = pd.read_csv(file_path_or_stream, engine="pyarrow", dtype_backend="pyarrow")
             
             # Validate required columns (PRD Section 5.1)
             required_cols = [CASE_ID_COL, ACTIVITY_COL, TIMESTAMP_COL]
@@ -54,7 +164,13 @@ def analyze_event_log(file_path_or_stream, original_filename):
                 missing = [col for col in required_cols if col not in df.columns]
                 raise ValueError(f"CSV file is missing required columns: {', '.join(missing)}. Expected: {', '.join(required_cols)}")
 
-            df = dataframe_utils.convert_timestamp_columns_in_df(df, timest_columns=[TIMESTAMP_COL])
+            if not pd.api.types.is_datetime64_any_dtype(df[TIMESTAMP_COL]):
+                # Arrow only infers ISO-8601; let pandas handle any other timestamp format
+                df[TIMESTAMP_COL] = pd.to_datetime(df[TIMESTAMP_COL], errors="coerce") # Unparsable/missing -> NaT
+
+            # Dictionary-encode the identity columns: groupby then works on integer codes, not Python strings
+            df[CASE_ID_COL] = df[CASE_ID_COL].astype("category")
+            df[ACTIVITY_COL] = df[ACTIVITY_COL].astype("category")
             
             # Rename columns to PM4PY standard format
             rename_map = {
@@ -66,57 +182,49 @@ def analyze_event_log(file_path_or_stream, original_filename):
                 rename_map[RESOURCE_COL] = PM4PY_RESOURCE_COL
 
             df.rename(columns=rename_map, inplace=True)
-            
-            event_log = log_converter.apply(df, variant=log_converter.Variants.TO_EVENT_LOG)
         
         elif file_type == '.xes':
             # PRD Section 6.A: Parse XES
             # Assuming file_path_or_stream is a path for XES for simplicity
-            # If it's a stream, pm4py.read_xes might need a path-like object or saved file
-            event_log = pm4py.read_xes(file_path_or_stream)
+            # iterparse also accepts a binary file object, so a stream works as well
+            df = _read_xes_events(file_path_or_stream)
         
         else:
             raise ValueError(f"Unsupported file type: {file_type}. Please upload .csv or .xes.")
 
         # PRD Section 6.A: Discover Directly Follows Graph (DFG)
-        dfg, start_activities, end_activities = pm4py.discover_dfg(event_log)
+        dfg, start_activities, end_activities, edge_lead_times, activity_durations = _discover_dfg_from_df(df)
         
         # --- Format Output (PRD Section 5.4 & 6.A) ---
-        nodes_map = {} # To store node data and ensure unique nodes
-        
         # Collect all unique activities from DFG for nodes
-        all_activities_in_dfg = set()
-        for (source, target) in dfg:
-            all_activities_in_dfg.add(source)
-            all_activities_in_dfg.add(target)
+        all_activities_in_dfg = {_intern_name(activity) for edge in dfg for activity in edge}
         
         # Add start/end activities that might not be in DFG edges (e.g., single activity traces)
-        for act in start_activities: all_activities_in_dfg.add(act)
-        for act in end_activities: all_activities_in_dfg.add(act)
+        all_activities_in_dfg.update(map(_intern_name, start_activities), map(_intern_name, end_activities))
 
-        # Calculate activity frequencies (occurrence in the log)
-        activity_stats = pm4py.get_event_attribute_values(event_log, PM4PY_ACTIVITY_COL, attribute_type=" διάρκ") # Uses 'concept:name'
+        # Calculate activity frequencies (occurrence in the log) in one pass over the activity column;
+        # only looked up by name below, so skip value_counts' descending sort
+        activity_stats = df[PM4PY_ACTIVITY_COL].value_counts(sort=False).to_dict()
         
-        nodes = []
-        for activity_name in all_activities_in_dfg:
-            if activity_name not in nodes_map:
-                node_data = {
-                    "id": activity_name,
-                    "label": activity_name,
-                    "frequency": activity_stats.get(activity_name, 0), # Get frequency from activity_stats
-                    "avg_duration_sec": None # Placeholder; requires more complex calculation if needed
-                }
-                nodes.append(node_data)
-                nodes_map[activity_name] = node_data
+        nodes = [
+            {
+                "id": activity_name,
+                "label": activity_name,
+                "frequency": activity_stats.get(activity_name, 0), # Get frequency from activity_stats
+                "avg_duration_sec": activity_durations.get(activity_name) # None if the activity only ends cases
+            }
+            for activity_name in all_activities_in_dfg
+        ]
         
-        links = []
-        for (source, target), count in dfg.items():
-            links.append({
-                "source": source,
-                "target": target,
+        links = [
+            {
+                "source": _intern_name(source),
+                "target": _intern_name(target),
                 "count": count,
-                "avg_lead_time_sec": None # Placeholder; requires event-level timestamp analysis
-            })
+                "avg_lead_time_sec": edge_lead_times.get((source, target))
+            }
+            for (source, target), count in dfg.items()
+        ]
             
         # (Optional for PoC) Add start/end "pseudo" nodes if desired for visualization
         # For now, focusing on DFG of actual activities